@@ -1,4 +0,0 @@
-# Dummy imghdr stub to prevent ModuleNotFoundError in Python 3.13+
-
-def what(*args, **kwargs):
-    return None
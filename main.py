@@ -1,11 +1,16 @@
 import os
-import fitz  # PyMuPDF
+import calendar
+import re
+import json
+import shutil
+import tempfile
 import datetime
+from zoneinfo import ZoneInfo
 import requests
-from telegram import Bot
+from requests.adapters import HTTPAdapter
+import urllib3
+from urllib3.util.retry import Retry
 from flask import Flask
-from apscheduler.schedulers.background import BackgroundScheduler
-import pytz
 import threading
 import time
 import logging
@@ -21,128 +26,382 @@ except KeyError as e:
     logging.critical(f"FATAL: Environment variable {e} not set. The application cannot start.")
     exit()
 
+TELEGRAM_API_URL = 'https://api.telegram.org/bot{token}/sendMessage'
+TELEGRAM_TIMEOUT = (5, 10)  # (connect, read) seconds
 GITHUB_PDF_URL = 'https://github.com/farhathkkk/acju-prayer-times/raw/main/Prayer-Times-{month}-{year}-COLOMBO.pdf'
-LOCAL_PDF = 'today.pdf'
+LOCAL_PDF = 'prayer_times_{month_key}.pdf'
+LOCAL_MESSAGES = 'messages_{month_key}.json'
+LOCAL_PDF_META = LOCAL_PDF + '.meta.json'
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+PDF_FRESH_SECONDS = 3600  # Don't recheck a PDF we confirmed within the last hour
+MAX_PDF_PAGES = 2  # The monthly calendar fits on a single page
+ROW_TOLERANCE = 3  # Max vertical offset (pt) between words on the same table row
 SELF_URL = os.getenv("SELF_URL")  # e.g., https://your-app.onrender.com
+KEEP_ALIVE_INTERVAL = 840  # Just under Render's 15-minute idle timeout
+SCHEDULER_LOCK = os.path.join(tempfile.gettempdir(), 'prayer_scheduler.lock')
+SEND_HOUR = int(os.getenv("SEND_HOUR", 10))
+SEND_MINUTE = int(os.getenv("SEND_MINUTE", 30))
+TIMEZONE = os.getenv("TIMEZONE", "Asia/Colombo")
+LOCAL_TZ = ZoneInfo(TIMEZONE)
 
-bot = Bot(token=BOT_TOKEN)
+MSG_TEMPLATE = (
+    "🕌 *Prayer Times - Colombo, Sri Lanka*\n"
+    "📅 *{date}*\n\n"
+    " Fajr\t\t\t- {fajr}\n"
+    " Sunrise\t- {sunrise}\n"
+    " Luhar\t\t- {luhar}\n"
+    " Asar\t\t\t- {asar}\n"
+    " Maghrib\t- {maghrib}\n"
+    " Isha\t\t\t- {isha}\n\n"
+    "Source: ACJU"
+)
 
-def download_pdf(target_date):
-    month = target_date.strftime('%B')
-    year = target_date.year
+# Matches a calendar date cell for the given month, e.g. "5-Oct"
+DATE_PATTERN = r'(\d{{1,2}})-{month_abbr}'
+
+# Any per-month file written from LOCAL_PDF, LOCAL_PDF_META or LOCAL_MESSAGES (incl. .part downloads)
+CACHE_FILE_RE = re.compile(r'(?:prayer_times|messages)_(\d{4}-\d{2})\.(?:pdf(?:\.meta\.json|\.part)?|json)')
+
+# One "HH:MM AM/PM" time in a calendar row
+TIME_RE = re.compile(r'(\d{1,2}:\d{2})\s+([AP]M)')
+
+# One pooled keep-alive session shared by the GitHub download and the Telegram Bot API,
+# retrying transient failures with backoff. Three host pools: github.com redirects the PDF
+# to raw.githubusercontent.com, plus api.telegram.org
+session = requests.Session()
+session.mount('https://', HTTPAdapter(
+    pool_connections=3,
+    pool_maxsize=4,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 502, 503, 504]),
+))
+
+# Rendered messages keyed by month ('YYYY-MM'), then by ISO date
+_MESSAGE_CACHE = {}
+
+def download_pdf(month_key, month, year):
+    local_pdf = LOCAL_PDF.format(month_key=month_key)
+    local_meta = LOCAL_PDF_META.format(month_key=month_key)
     url = GITHUB_PDF_URL.format(month=month, year=year)
-    
+
+    # One stat answers both "do we have a copy?" and "is it the size we recorded?"
+    try:
+        pdf_stat = os.stat(local_pdf)
+    except FileNotFoundError:
+        pdf_stat = None
+
+    # The meta file is touched on every successful check, so its mtime says when we last
+    # confirmed this month's PDF; skip the round-trip if that was recent
+    try:
+        age = time.time() - os.path.getmtime(local_meta)
+    except OSError:
+        age = float('inf')
+    if age < PDF_FRESH_SECONDS and pdf_stat:
+        logging.info(f"PDF '{local_pdf}' was checked {int(age)}s ago, skipping download.")
+        return True
+
+    # Revalidate the copy we already have instead of downloading it again
+    headers = {}
+    have_valid_copy = False
+    if pdf_stat:
+        try:
+            with open(local_meta) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            meta = {}
+        # A copy that doesn't match the size we recorded can't be trusted, even on a 304
+        if meta.get('size') != pdf_stat.st_size:
+            meta = {}
+        have_valid_copy = bool(meta)
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
     logging.info(f"Downloading PDF from {url}")
     try:
-        response = requests.get(url, timeout=15)
-        # Raise an exception if the download failed (e.g., 404 Not Found)
-        response.raise_for_status()
-        with open(LOCAL_PDF, 'wb') as f:
-            f.write(response.content)
+        with session.get(url, headers=headers, timeout=15, stream=True) as response:
+            if response.status_code == 304:
+                os.utime(local_meta)
+                logging.info(f"PDF not modified, using cached '{local_pdf}'.")
+                return True
+            # Raise an exception if the download failed (e.g., 404 Not Found)
+            response.raise_for_status()
+            # Let urllib3 undo any Content-Encoding while copying socket -> file
+            response.raw.decode_content = True
+            # Stream to a temp file so a dropped connection never leaves a truncated PDF in the cache
+            with open(local_pdf + '.part', 'wb') as f:
+                shutil.copyfileobj(response.raw, f, length=DOWNLOAD_CHUNK_SIZE)
+            os.replace(local_pdf + '.part', local_pdf)
+            with open(local_meta, 'w') as f:
+                json.dump({
+                    'etag': response.headers.get('ETag'),
+                    'last_modified': response.headers.get('Last-Modified'),
+                    'size': os.path.getsize(local_pdf),
+                }, f)
+        # The PDF changed, so messages built from the old copy are stale
+        _MESSAGE_CACHE.pop(month_key, None)
+        try:
+            os.remove(LOCAL_MESSAGES.format(month_key=month_key))
+        except FileNotFoundError:
+            pass
         logging.info("PDF downloaded successfully.")
+        prune_old_months(month_key)
         return True
-    except requests.exceptions.RequestException as e:
+    # Reading response.raw directly surfaces urllib3's own errors, not requests' wrappers
+    except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as e:
         logging.error(f"Failed to download PDF. Error: {e}")
+        try:
+            os.remove(local_pdf + '.part')
+        except FileNotFoundError:
+            pass
+        # A failed check doesn't invalidate the copy we already confirmed; keep serving it
+        if have_valid_copy:
+            logging.warning(f"Falling back to cached '{local_pdf}'.")
+            return True
         return False
 
-def extract_tomorrows_prayers(tomorrow_date):
+# Remove cached files and messages for months before month_key; we only ever look ahead
+def prune_old_months(month_key):
+    for name in os.listdir('.'):
+        match = CACHE_FILE_RE.fullmatch(name)
+        if not match or match.group(1) >= month_key:
+            continue
+        try:
+            os.remove(name)
+            logging.info(f"Removed old cache file '{name}'.")
+        except OSError as e:
+            logging.warning(f"Could not remove old cache file '{name}'. Error: {e}")
+    for old_key in [key for key in _MESSAGE_CACHE if key < month_key]:
+        del _MESSAGE_CACHE[old_key]
+
+def send_message(text, parse_mode=None):
+    payload = {"chat_id": CHAT_ID, "text": text}
+    if parse_mode:
+        payload["parse_mode"] = parse_mode
+    try:
+        response = session.post(TELEGRAM_API_URL.format(token=BOT_TOKEN), json=payload, timeout=TELEGRAM_TIMEOUT)
+        result = response.json()
+    except (requests.exceptions.RequestException, ValueError) as e:
+        # The request URL embeds the bot token, so keep it out of logs and alerts
+        raise RuntimeError(f"Telegram request failed: {str(e).replace(BOT_TOKEN, '<token>')}") from None
+    if not result.get("ok"):
+        raise RuntimeError(f"Telegram API error: {result.get('description')}")
+
+# Parse every calendar row of the monthly PDF in a single pass
+def parse_month(local_pdf, month_abbr, days_in_month):
+    # PyMuPDF is heavy to import and only needed on a cache miss, so load it here
+    import fitz
+
     try:
-        doc = fitz.open(LOCAL_PDF)
-    except fitz.errors.FitzError as e:
-        logging.error(f"Could not open or read the PDF file '{LOCAL_PDF}'. It may be corrupted. Error: {e}")
-        return None, tomorrow_date
-
-    # Use a format that works across different operating systems
-    tomorrow_str = tomorrow_date.strftime('%#d-%b' if os.name == 'nt' else '%-d-%b')
-
-    for page in doc:
-        lines = page.get_text("text").split('\n')
-        for i, line in enumerate(lines):
-            cleaned_line = line.strip()
-            # Find the line that starts with the date
-            if cleaned_line.startswith(tomorrow_str):
-                # Assume the times are on the same line
-                if len(cleaned_line.split()) > 5:
-                    return cleaned_line, tomorrow_date
-                # If not, assume the times are on the next non-empty line
-                elif i + 1 < len(lines):
-                    for next_line in lines[i+1:]:
-                        if next_line.strip():
-                            return f"{cleaned_line} {next_line.strip()}", tomorrow_date
-    return None, tomorrow_date
+        doc = fitz.open(local_pdf)
+    # FileDataError / EmptyFileError (and older PyMuPDF's plain errors) are RuntimeErrors
+    except RuntimeError as e:
+        logging.error(f"Could not open or read the PDF file '{local_pdf}'. It may be corrupted. Error: {e}")
+        return None
+
+    # Plain text only; the calendar needs no image or ligature handling
+    text_flags = fitz.TEXTFLAGS_TEXT & ~fitz.TEXT_PRESERVE_IMAGES & ~fitz.TEXT_PRESERVE_LIGATURES
+    date_re = re.compile(DATE_PATTERN.format(month_abbr=re.escape(month_abbr)))
+    prayers = {}
+    try:
+        for page_index in range(min(MAX_PDF_PAGES, doc.page_count)):
+            # Every day is accounted for, so the remaining pages can't add anything
+            if len(prayers) == days_in_month:
+                break
+            page = doc.load_page(page_index)
+            # Lay the page out once and share it between the search and the extraction
+            textpage = page.get_textpage(flags=text_flags)
+            # Let MuPDF's native search rule out pages without this month's dates (cover, notes)
+            if not page.search_for(f"-{month_abbr}", textpage=textpage):
+                continue
+            # Flat (x0, y0, x1, y1, word, ...) tuples are far cheaper than the nested "dict" output
+            words = sorted((w[1], w[0], w[4]) for w in page.get_text("words", textpage=textpage))
+            # Group the words into table rows in one top-to-bottom pass, so we don't depend
+            # on the order MuPDF linearizes the cells in
+            rows = []
+            for y, x, text in words:
+                if rows and y - rows[-1][0] < ROW_TOLERANCE:
+                    rows[-1][1].append((x, text))
+                else:
+                    rows.append((y, [(x, text)]))
+
+            for _, row in rows:
+                row.sort()
+                # Calendar rows start with the date cell
+                match = date_re.fullmatch(row[0][1])
+                if not match:
+                    continue
+                # Key by the day number so "05-Oct" and "5-Oct" both resolve
+                day = int(match.group(1))
+                if not 1 <= day <= days_in_month:
+                    logging.warning(f"Skipping row with out-of-range date {row[0][1]}")
+                    continue
+                if day in prayers:
+                    continue
+                line = ' '.join(t for _, t in row)
+                times = [f"{m.group(1)} {m.group(2)}" for m in TIME_RE.finditer(line)]
+                if len(times) < 6:
+                    logging.warning(f"Skipping malformed row for {row[0][1]}. Expected 6 times, but got {len(times)}: '{line}'")
+                    continue
+                # Store just the six "HH:MM AM" times, in calendar order
+                prayers[day] = times[:6]
+    finally:
+        # Free MuPDF's buffers as soon as we are done with the document, and empty
+        # its global resource store too; nothing else uses it until next month
+        doc.close()
+        fitz.TOOLS.store_shrink(100)
+    return prayers
+
+# Render every day's message for the month, keyed by ISO date
+def precompute_month(prayers, year, month):
+    messages = {}
+    for day, times in prayers.items():
+        date = datetime.date(year, month, day)
+        fajr, sunrise, luhar, asar, maghrib, isha = times
+        messages[date.isoformat()] = MSG_TEMPLATE.format_map({
+            'date': date.strftime("%A, %d %B %Y"),
+            'fajr': fajr,
+            'sunrise': sunrise,
+            'luhar': luhar,
+            'asar': asar,
+            'maghrib': maghrib,
+            'isha': isha,
+        })
+    return messages
+
+# Return the month's ready-to-send messages, parsing the PDF only on a cache miss
+def load_month(month_key, month_abbr):
+    if month_key in _MESSAGE_CACHE:
+        return _MESSAGE_CACHE[month_key]
+
+    local_messages = LOCAL_MESSAGES.format(month_key=month_key)
+    try:
+        with open(local_messages) as f:
+            messages = json.load(f)
+    except (OSError, ValueError):
+        year, month = map(int, month_key.split('-'))
+        days_in_month = calendar.monthrange(year, month)[1]
+        prayers = parse_month(LOCAL_PDF.format(month_key=month_key), month_abbr, days_in_month)
+        if not prayers:
+            return None
+        messages = precompute_month(prayers, year, month)
+        # Persist next to the PDF so a restart doesn't have to parse it again
+        with open(local_messages, 'w') as f:
+            json.dump(messages, f)
+
+    _MESSAGE_CACHE[month_key] = messages
+    return messages
+
+def get_daily_message(month_key, month_abbr, date_iso):
+    messages = load_month(month_key, month_abbr)
+    if not messages:
+        return None
+    return messages.get(date_iso)
 
 def send_daily_prayers():
     try:
         logging.info("Running send_daily_prayers job...")
-        colombo_tz = pytz.timezone("Asia/Colombo")
-        tomorrow = datetime.datetime.now(colombo_tz) + datetime.timedelta(days=1)
-        
-        if not download_pdf(tomorrow):
-            bot.send_message(chat_id=CHAT_ID, text="🚨 Alert: Failed to download the prayer times PDF.")
-            return
+        tomorrow = datetime.datetime.now(LOCAL_TZ) + datetime.timedelta(days=1)
+        # Format everything we need from tomorrow's date once per run
+        month_key = tomorrow.strftime('%Y-%m')
+        month = tomorrow.strftime('%B')
+        month_abbr = tomorrow.strftime('%b')
+        date_iso = tomorrow.date().isoformat()
 
-        raw, t_date = extract_tomorrows_prayers(tomorrow)
-        if not raw:
-            logging.error("No prayer time found after parsing PDF.")
-            bot.send_message(chat_id=CHAT_ID, text=f"🔍 Alert: Could not find prayer times for {tomorrow.strftime('%d-%b')} in the PDF.")
+        if not download_pdf(month_key, month, tomorrow.year):
+            send_message("🚨 Alert: Failed to download the prayer times PDF.")
             return
 
-        parts = raw.split()
-        if len(parts) < 13:
-            logging.error(f"Line format error. Expected 13+ parts, but got {len(parts)}: '{raw}'")
-            bot.send_message(chat_id=CHAT_ID, text=f"📄 Alert: Found the line for tomorrow, but the format was incorrect: `{raw}`")
+        msg = get_daily_message(month_key, month_abbr, date_iso)
+        if not msg:
+            logging.error("No prayer time found after parsing PDF.")
+            send_message(f"🔍 Alert: Could not find valid prayer times for {date_iso} in the PDF.")
             return
 
-        date_str = t_date.strftime("%A, %d %B %Y")
-        msg = (
-            f"🕌 *Prayer Times - Colombo, Sri Lanka*\n"
-            f"📅 *{date_str}*\n\n"
-            f" Fajr\t\t\t- {parts[1]} {parts[2]}\n"
-            f" Sunrise\t- {parts[3]} {parts[4]}\n"
-            f" Luhar\t\t- {parts[5]} {parts[6]}\n"
-            f" Asar\t\t\t- {parts[7]} {parts[8]}\n"
-            f" Maghrib\t- {parts[9]} {parts[10]}\n"
-            f" Isha\t\t\t- {parts[11]} {parts[12]}\n\n"
-            f"Source: ACJU"
-        )
-
-        bot.send_message(chat_id=CHAT_ID, text=msg, parse_mode='Markdown')
+        send_message(msg, parse_mode='Markdown')
         logging.info("Message sent successfully.")
 
     except Exception as e:
         logging.critical(f"An unexpected error occurred in send_daily_prayers: {e}", exc_info=True)
         try:
-            bot.send_message(chat_id=CHAT_ID, text=f"🚨 **BOT ERROR** 🚨\n\nThe bot ran into a critical error: `{e}`")
+            send_message(f"🚨 **BOT ERROR** 🚨\n\nThe bot ran into a critical error: `{e}`")
         except Exception as telegram_error:
             logging.error(f"Could not send the error notification to Telegram: {telegram_error}")
 
 # === APScheduler Setup ===
-scheduler = BackgroundScheduler(timezone=pytz.timezone("Asia/Colombo"))
-scheduler.add_job(send_daily_prayers, trigger='cron', hour=10, minute=30)
-scheduler.start()
-logging.info("Scheduler started for 10:30 AM daily (Asia/Colombo).")
+def _start_scheduler():
+    # Only the process that owns the daily job needs APScheduler
+    from apscheduler.schedulers.background import BackgroundScheduler
+
+    scheduler = BackgroundScheduler(timezone=LOCAL_TZ)
+    scheduler.add_job(send_daily_prayers, trigger='cron', hour=SEND_HOUR, minute=SEND_MINUTE)
+    scheduler.start()
+    logging.info(f"Scheduler started for {SEND_HOUR:02d}:{SEND_MINUTE:02d} daily ({TIMEZONE}).")
+    return scheduler
 
 # === Flask App ===
 app = Flask(__name__)
 
+# When the app last served a request; the keep-alive ping only fires after a quiet spell
+_last_request_ts = time.time()
+
+@app.before_request
+def record_request():
+    global _last_request_ts
+    _last_request_ts = time.time()
+
 @app.route('/')
 def home():
     return "Prayer Times Bot is live!"
 
 # === Self-ping thread to prevent shutdown ===
 def keep_alive():
+    ping_session = requests.Session()
+    last_ping = 0
     while True:
-        time.sleep(600)  # Sleep for 10 minutes
-        if not SELF_URL:
+        # Sleep until a full interval has passed since the last request or ping; a request
+        # that arrives meanwhile (e.g. from an uptime monitor) just pushes the deadline back
+        wait = max(_last_request_ts, last_ping) + KEEP_ALIVE_INTERVAL - time.time()
+        if wait > 0:
+            time.sleep(wait)
             continue
+        # Count failed pings too, so an unreachable SELF_URL doesn't turn this into a busy loop
+        last_ping = time.time()
         try:
-            requests.get(SELF_URL, timeout=10)
+            ping_session.get(SELF_URL, timeout=5)
             logging.info("Self-ping successful.")
         except Exception as e:
             logging.error(f"Self-ping failed: {e}")
 
-threading.Thread(target=keep_alive, daemon=True).start()
-logging.info("Keep-alive thread started.")
+# === Background jobs ===
+_scheduler_lock = None
+
+# Start the daily job and the self-ping, but only in one process: under a multi-worker
+# WSGI server every worker imports this module, and the first to take the lock wins
+def start_background_jobs():
+    global _scheduler_lock
+    try:
+        import fcntl
+    except ImportError:
+        fcntl = None  # No flock on this platform; assume a single process
+    if fcntl:
+        lock_file = open(SCHEDULER_LOCK, 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            logging.info("Another process owns the scheduler, not starting background jobs.")
+            return
+        # Hold the lock (and its file handle) for the life of the process
+        _scheduler_lock = lock_file
+
+    _start_scheduler()
+    if SELF_URL:
+        threading.Thread(target=keep_alive, daemon=True).start()
+        logging.info("Keep-alive thread started.")
+
+# Every process that imports the app competes for the lock, so exactly one schedules the send
+start_background_jobs()
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 8080))